@@ -28,9 +28,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import ast
+import collections
+import contextlib
+import hashlib
 import io
+import json
+import math
+import os
 import signal
 import sys
+import time
 
 import autoflake
 import autopep8
@@ -40,15 +48,116 @@ import unify
 
 __version__ = '1.0'
 
+AUTO_JOBS = 'auto'
+
+# Number of threads reading files ahead of formatting them.
+READ_AHEAD_THREADS = 4
+
+# Bytes at the start of a file that are inspected for signs that it was
+# generated.
+GENERATED_HEADER_SIZE = 4096
+
+# Markers that "--skip-generated" looks for in the header of a file.
+GENERATED_MARKERS = (b'@generated', b'DO NOT EDIT')
+
+# Lines longer than this are taken as a sign of generated code.
+GENERATED_LINE_LENGTH = 1000
+
+# Amount of source each worker should get before "--jobs=auto" considers a
+# process pool worth its start-up cost.
+BYTES_PER_JOB = 128 * 1024
+
+
+class StageCache(object):
+    """Least recently used cache of formatter stage outputs.
+
+    Entries are keyed by the stage, its options, and a digest of the text
+    the stage was given. The cache is bounded by the memory, in bytes,
+    taken up by the cached outputs.
+
+    This is meant for long-lived callers that format the same text
+    repeatedly, such as watch mode or editor integrations.
+
+    """
+
+    def __init__(self, max_size=2 ** 26):
+        """Create cache holding at most max_size bytes of outputs."""
+        self.max_size = max_size
+        self._size = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        """Return number of cached outputs."""
+        return len(self._entries)
+
+    def get(self, key):
+        """Return cached output for key or None."""
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return None
+
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """Cache value under key, evicting the least recently used."""
+        size = sys.getsizeof(value)
+        if size > self.max_size:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= sys.getsizeof(previous)
+
+        self._entries[key] = value
+        self._size += size
+
+        while self._size > self.max_size:
+            (_, evicted) = self._entries.popitem(last=False)
+            self._size -= sys.getsizeof(evicted)
+
+    def clear(self):
+        """Remove all entries."""
+        self._entries.clear()
+        self._size = 0
+
+
+def _freeze(value):
+    """Return hashable equivalent of an option value."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for (key, item) in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _options_key(options):
+    """Return hashable key of the autopep8 options used for fixing."""
+    return tuple(sorted((name, _freeze(value))
+                        for (name, value) in vars(options).items()
+                        if name != 'files'))
+
+
+def _stages(aggressive, apply_config, filename='',
+            remove_all_unused_imports=False, remove_unused_variables=False):
+    """Return list of (key, formatter) pairs.
+
+    The key identifies the formatter and the options it was built with.
+
+    """
+    stages = []
 
-def formatters(aggressive, apply_config, filename='',
-               remove_all_unused_imports=False, remove_unused_variables=False):
-    """Return list of code formatters."""
     if aggressive:
-        yield lambda code: autoflake.fix_code(
-            code,
-            remove_all_unused_imports=remove_all_unused_imports,
-            remove_unused_variables=remove_unused_variables)
+        stages.append((
+            ('autoflake', remove_all_unused_imports, remove_unused_variables),
+            lambda code: autoflake.fix_code(
+                code,
+                remove_all_unused_imports=remove_all_unused_imports,
+                remove_unused_variables=remove_unused_variables)))
 
         autopep8_options = autopep8.parse_args(
             [filename] + int(aggressive) * ['--aggressive'],
@@ -57,85 +166,685 @@ def formatters(aggressive, apply_config, filename='',
         autopep8_options = autopep8.parse_args(
             [filename], apply_config=apply_config)
 
-    yield lambda code: autopep8.fix_code(code, options=autopep8_options)
-    yield docformatter.format_code
-    yield unify.format_code
+    stages.append((
+        ('autopep8', _options_key(autopep8_options)),
+        lambda code: autopep8.fix_code(code, options=autopep8_options)))
+    stages.append((('docformatter',), docformatter.format_code))
+    stages.append((('unify',), unify.format_code))
 
+    return stages
 
-def format_code(source, aggressive=False, apply_config=False, filename='',
-                remove_all_unused_imports=False,
-                remove_unused_variables=False):
-    """Return formatted source code."""
+
+def formatters(aggressive, apply_config, filename='',
+               remove_all_unused_imports=False, remove_unused_variables=False):
+    """Return list of code formatters."""
+    for (_, fix) in _stages(aggressive, apply_config, filename,
+                            remove_all_unused_imports,
+                            remove_unused_variables):
+        yield fix
+
+
+def _digest(text):
+    """Return digest of text."""
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).digest()
+
+
+def _run_stage(key, fix, source, cache):
+    """Return output of fix() on source, reusing cached output."""
+    if cache is None:
+        return fix(source)
+
+    key = key + (_digest(source),)
+    formatted_source = cache.get(key)
+    if formatted_source is None:
+        formatted_source = fix(source)
+        cache.put(key, formatted_source)
+
+    return formatted_source
+
+
+def _parse(source, filename=''):
+    """Return syntax tree of source.
+
+    Raise SyntaxError if source is not valid Python.
+
+    """
+    return ast.parse(source, filename=filename or '<string>')
+
+
+@contextlib.contextmanager
+def _sharing_tree(source, tree):
+    """Make autoflake check source with its already parsed tree.
+
+    autoflake parses whatever it is given with pyflakes. Within this
+    block, checking the exact source object that was parsed reuses tree
+    instead. This is not thread-safe.
+
+    """
+    check = autoflake.check
+
+    def check_with_tree(code):
+        if code is not source:
+            return check(code)
+
+        import pyflakes.checker
+        messages = pyflakes.checker.Checker(tree,
+                                            filename='<string>').messages
+        return sorted(messages, key=lambda message: message.lineno)
+
+    autoflake.check = check_with_tree
+    try:
+        yield
+    finally:
+        autoflake.check = check
+
+
+def _run_stages(source, stages, cache, memory=None):
+    """Return source after running it through each stage.
+
+    If given, memory is the MemoryTracker to measure each stage with.
+
+    """
     formatted_source = source
 
-    for fix in formatters(
-            aggressive, apply_config, filename,
-            remove_all_unused_imports, remove_unused_variables):
-        formatted_source = fix(formatted_source)
+    for (key, fix) in stages:
+        with _measure(memory, key[0]):
+            formatted_source = _run_stage(key, fix, formatted_source, cache)
 
     return formatted_source
 
 
-def format_file(filename, args, standard_out):
-    """Run format_code() on a file.
+def _run_stages_until_stable(source, stages, cache, memory=None,
+                             max_passes=10):
+    """Return (formatted_source, passes) after formatting until stable.
 
-    Return True if the new formatting differs from the original.
+    Stages are run in a cycle until each one has seen the current text
+    without changing it, or until max_passes passes were started. A stage
+    is assumed to be idempotent, so it is not rerun on its own output, and
+    the stages after the one that last changed the text only run again if
+    an earlier stage changes it.
 
     """
+    formatted_source = source
+    stable = 0
+    runs = 0
+
+    while stable < len(stages) and runs < max_passes * len(stages):
+        (key, fix) = stages[runs % len(stages)]
+        with _measure(memory, key[0]):
+            result = _run_stage(key, fix, formatted_source, cache)
+
+        stable = stable + 1 if result == formatted_source else 1
+        formatted_source = result
+        runs += 1
+
+    return (formatted_source, -(-runs // len(stages)))
+
+
+def format_code(source, aggressive=False, apply_config=False, filename='',
+                remove_all_unused_imports=False,
+                remove_unused_variables=False, cache=None):
+    """Return formatted source code.
+
+    Raise SyntaxError if source is not valid Python, before any formatter
+    runs. If cache is a StageCache, the output of each stage is memoized
+    in it, so that reformatting text that only changed in later stages
+    reuses the earlier work.
+
+    """
+    tree = _parse(source, filename)
+
+    with _sharing_tree(source, tree):
+        return _run_stages(
+            source,
+            _stages(aggressive, apply_config, filename,
+                    remove_all_unused_imports, remove_unused_variables),
+            cache)
+
+
+_stages_by_configuration = {}
+
+
+def _cached_stages(args, filename):
+    """Return stages for formatting filename.
+
+    The stages are built once per set of options and, when configuration
+    files are applied, once per directory.
+
+    """
+    directory = (os.path.dirname(os.path.abspath(filename))
+                 if args.config else '')
+    key = (args.aggressive, args.config, directory,
+           args.remove_all_unused_imports, args.remove_unused_variables)
+
+    try:
+        return _stages_by_configuration[key]
+    except KeyError:
+        stages = _stages(
+            args.aggressive,
+            apply_config=args.config,
+            filename=filename,
+            remove_all_unused_imports=args.remove_all_unused_imports,
+            remove_unused_variables=args.remove_unused_variables)
+        _stages_by_configuration[key] = stages
+        return stages
+
+
+def _read_file(filename):
+    """Return (encoding, source) of file."""
     encoding = autopep8.detect_encoding(filename)
     with autopep8.open_with_encoding(filename,
                                      encoding=encoding) as input_file:
-        source = input_file.read()
+        return (encoding, input_file.read())
+
+
+class MemoryTracker(object):
+    """Record memory allocated while formatting a file, phase by phase.
+
+    This requires tracemalloc to be tracing. On Python versions without
+    tracemalloc.reset_peak(), peaks include earlier phases.
+
+    """
+
+    def __init__(self):
+        """Create tracker with no phases recorded."""
+        self.phases = []
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        """Record (phase, peak, retained) bytes allocated in the block."""
+        import tracemalloc
+        (before, _) = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        try:
+            yield
+        finally:
+            (current, peak) = tracemalloc.get_traced_memory()
+            self.phases.append((phase,
+                                max(0, peak - before),
+                                current - before))
+
+
+@contextlib.contextmanager
+def _measure(memory, phase):
+    """Measure block with memory.measure() unless memory is None."""
+    if memory is None:
+        yield
+    else:
+        with memory.measure(phase):
+            yield
+
+
+def _max_rss():
+    """Return peak resident set size of this process in bytes or None."""
+    try:
+        import resource
+    except ImportError:  # pragma: no cover
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes while macOS reports bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _write_diff(source, formatted_source, filename, standard_out):
+    """Write unified diff between source and formatted_source."""
+    diff = autopep8.get_diff_text(
+        io.StringIO(source).readlines(),
+        io.StringIO(formatted_source).readlines(),
+        filename)
+    standard_out.write(''.join(diff))
+
+
+def format_file(filename, args, standard_out, read=None, cache=None,
+                memory=None, report=None):
+    """Run format_code() on a file.
+
+    Return True if the new formatting differs from the original. Raise
+    SyntaxError if the file is not valid Python.
+
+    If given, read() returns the (encoding, source) of the already read
+    file, cache is the StageCache to memoize stage outputs in, memory is
+    the MemoryTracker to measure each phase with, and report is a
+    dictionary that receives the number of "passes" made with
+    "--until-stable" and, if the file changed, its "encoding", "source",
+    and "formatted_source".
+
+    """
+    with _measure(memory, 'read'):
+        if read is None:
+            (encoding, source) = _read_file(filename)
+        else:
+            (encoding, source) = read()
 
     if not source:
         return False
 
-    formatted_source = format_code(
-        source,
-        aggressive=args.aggressive,
-        apply_config=args.config,
-        filename=filename,
-        remove_all_unused_imports=args.remove_all_unused_imports,
-        remove_unused_variables=args.remove_unused_variables)
+    with _measure(memory, 'parse'):
+        tree = _parse(source, filename)
+
+    stages = _cached_stages(args, filename)
+    with _sharing_tree(source, tree):
+        if args.until_stable:
+            (formatted_source, passes) = _run_stages_until_stable(
+                source, stages, cache, memory, max_passes=args.max_passes)
+            if report is not None:
+                report['passes'] = passes
+        else:
+            formatted_source = _run_stages(source, stages, cache, memory)
 
     if source != formatted_source:
+        if report is not None:
+            report['encoding'] = encoding
+            report['source'] = source
+            report['formatted_source'] = formatted_source
+
         if args.in_place:
-            with autopep8.open_with_encoding(filename, mode='w',
-                                             encoding=encoding) as output_file:
-                output_file.write(formatted_source)
+            with _measure(memory, 'write'):
+                with autopep8.open_with_encoding(
+                        filename, mode='w',
+                        encoding=encoding) as output_file:
+                    output_file.write(formatted_source)
         else:
-            diff = autopep8.get_diff_text(
-                io.StringIO(source).readlines(),
-                io.StringIO(formatted_source).readlines(),
-                filename)
-            standard_out.write(''.join(diff))
+            with _measure(memory, 'diff'):
+                _write_diff(source, formatted_source, filename, standard_out)
 
         return True
 
     return False
 
 
-def _format_file(parameters):
+def _skip_reason(filename, args):
+    """Return why file should not be formatted or None.
+
+    Only the size of the file and the start of it are looked at.
+
+    """
+    size = _file_size(filename)
+    if args.max_file_size and size > args.max_file_size:
+        return 'larger than {0} bytes'.format(args.max_file_size)
+
+    if args.skip_generated:
+        with open(filename, 'rb') as input_file:
+            header = input_file.read(GENERATED_HEADER_SIZE)
+
+        for marker in GENERATED_MARKERS:
+            if marker in header:
+                return 'generated'
+
+        lines = header.split(b'\n')
+        if len(header) < size:
+            # The last line is cut off.
+            lines = lines[:-1] or lines
+        if max(len(line) for line in lines) > GENERATED_LINE_LENGTH:
+            return 'generated'
+
+    return None
+
+
+# Outcome of formatting a file. "skipped" is the reason the file was not
+# formatted. "memory" is (phases, max_rss) if the memory report is enabled.
+# "passes" is the number of passes made with "--until-stable".
+_Result = collections.namedtuple('_Result',
+                                 ['changed', 'error', 'skipped', 'memory',
+                                  'passes'])
+
+
+def _format_file(parameters, read=None, cache=None, report=None):
     """Helper function for optionally running format_file() in parallel."""
-    (filename, args, _, standard_error) = parameters
+    (filename, args, standard_out, standard_error) = parameters
 
     standard_error = standard_error or sys.stderr
 
     if args.verbose:
         print('{0}: '.format(filename), end='', file=standard_error)
 
+    memory = MemoryTracker() if args.memory_report else None
+    if report is None:
+        report = {}
     try:
-        changed = format_file(*parameters[:-1])
-    except IOError as exception:
+        skipped = _skip_reason(filename, args)
+        if skipped:
+            changed = False
+        else:
+            changed = format_file(filename, args, standard_out,
+                                  read=read, cache=cache, memory=memory,
+                                  report=report)
+    except (IOError, SyntaxError, ValueError) as exception:
         print('{}'.format(exception), file=standard_error)
-        return (False, True)
+        return _Result(changed=False, error=True, skipped=None, memory=None,
+                       passes=None)
     except KeyboardInterrupt:  # pragma: no cover
-        return (False, True)  # pragma: no cover
+        return _Result(changed=False, error=True,  # pragma: no cover
+                       skipped=None, memory=None, passes=None)
 
     if args.verbose:
-        print('changed' if changed else 'unchanged', file=standard_error)
+        if skipped:
+            print('skipped ({0})'.format(skipped), file=standard_error)
+        elif 'passes' in report:
+            print('{0} ({1} passes)'.format(
+                'changed' if changed else 'unchanged', report['passes']),
+                file=standard_error)
+        else:
+            print('changed' if changed else 'unchanged',
+                  file=standard_error)
+
+    return _Result(changed=changed,
+                   error=False,
+                   skipped=skipped,
+                   memory=(memory.phases, _max_rss()) if memory else None,
+                   passes=report.get('passes'))
+
+
+def _print_memory_report(filenames, results, standard_error, top=10):
+    """Print the stages and files that allocated the most memory."""
+    stages = collections.OrderedDict()
+    files = []
+    for (name, result) in zip(filenames, results):
+        if not result.memory:
+            continue
+
+        (phases, rss) = result.memory
+        for (phase, peak, retained) in phases:
+            (max_peak, total_retained) = stages.get(phase, (0, 0))
+            stages[phase] = (max(max_peak, peak), total_retained + retained)
+
+        if phases:
+            (phase, peak, _) = max(phases, key=lambda item: item[1])
+            files.append((peak, phase, rss, name))
+
+    kib = 1024
+    print('memory report (KiB):', file=standard_error)
+    for (phase, (max_peak, total_retained)) in stages.items():
+        print('  {0:<12} max peak {1:>10} retained {2:>10}'.format(
+            phase, max_peak // kib, total_retained // kib),
+            file=standard_error)
+
+    for (peak, phase, rss, name) in sorted(files, reverse=True)[:top]:
+        print('  {0}: peak {1} in {2}, max RSS {3}'.format(
+            name, peak // kib, phase,
+            'unknown' if rss is None else rss // kib),
+            file=standard_error)
+
+
+def _file_size(filename):
+    """Return size of file or 0 if it cannot be determined."""
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
 
-    return (changed, False)
+def _read_ahead(filenames, max_bytes, threads=READ_AHEAD_THREADS):
+    """Yield (filename, read) pairs while reading upcoming files in threads.
+
+    read() returns what _read_file() would for filename. Files are read
+    ahead until max_bytes are in flight, but at least one file is always
+    read ahead.
+
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+
+    queue = collections.deque((name, _file_size(name)) for name in filenames)
+    pending = collections.deque()
+    in_flight = 0
+
+    try:
+        while queue or pending:
+            while queue and (not pending or
+                             in_flight + queue[0][1] <= max_bytes):
+                (name, size) = queue.popleft()
+                pending.append((name, size,
+                                pool.apply_async(_read_file, (name,))))
+                in_flight += size
+
+            (name, size, result) = pending.popleft()
+            result.wait()
+            yield (name, result.get)
+            in_flight -= size
+    finally:
+        pool.terminate()
+
+
+_worker_args = None
+
+
+def _initialize_worker(args):
+    """Store the arguments that every task in this worker process uses."""
+    global _worker_args
+    _worker_args = args
+
+    if args is not None and args.memory_report:
+        import tracemalloc
+        tracemalloc.start()
+
+
+def _format_group_in_worker(names):
+    """Run _format_group() on names in a worker process.
+
+    Return (results, diff) where diff is the text the group wrote to
+    standard output.
+
+    """
+    # We pass neither standard_out nor standard_error into "_format_group()"
+    # since multiprocessing cannot serialize io.
+    standard_out = io.StringIO()
+    results = _format_group(names, _worker_args, standard_out, None)
+    return (results, standard_out.getvalue())
+
+
+def _cgroup_cpu_quota(root='/sys/fs/cgroup'):
+    """Return number of CPUs allowed by the cgroup or None if unlimited."""
+    try:
+        with open(os.path.join(root, 'cpu.max')) as quota_file:
+            (quota, period) = quota_file.read().split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        with open(os.path.join(root, 'cpu', 'cpu.cfs_quota_us')) as quota_file:
+            quota = int(quota_file.read())
+        with open(os.path.join(root, 'cpu',
+                               'cpu.cfs_period_us')) as period_file:
+            period = int(period_file.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+    if quota > 0 and period > 0:
+        return quota / period
+    return None
+
+
+def cpu_count():
+    """Return number of CPUs this process may use.
+
+    Unlike multiprocessing.cpu_count(), this respects CPU affinity and
+    cgroup CPU quotas.
+
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        count = multiprocessing.cpu_count()
+
+    quota = _cgroup_cpu_quota()
+    if quota:
+        count = min(count, max(1, int(math.ceil(quota))))
+
+    return count
+
+
+def _auto_jobs(filenames):
+    """Return number of jobs suited to the amount of source in filenames.
+
+    Small batches are formatted serially since starting a pool of workers
+    would cost more than the work itself.
+
+    """
+    total_size = sum(_file_size(name) for name in filenames)
+    return max(1, min(cpu_count(),
+                      len(filenames),
+                      total_size // BYTES_PER_JOB))
+
+
+def _shard_costs(filenames, costs):
+    """Return dictionary mapping filenames to their estimated cost.
+
+    Files missing from costs are estimated from their size, scaled by the
+    cost per byte of the files that have a recorded cost.
+
+    """
+    sizes = dict((name, _file_size(name)) for name in filenames)
+    if not costs:
+        return sizes
+
+    known = {}
+    for name in filenames:
+        for key in (name, os.path.realpath(name)):
+            if key in costs:
+                known[name] = costs[key]
+                break
+
+    known_size = sum(sizes[name] for name in known)
+    cost_per_byte = (sum(known.values()) / known_size) if known_size else 1
+
+    return dict((name, known.get(name, sizes[name] * cost_per_byte))
+                for name in filenames)
+
+
+def shards(filenames, count, costs=None):
+    """Return list of count lists of filenames with balanced total cost.
+
+    Files are assigned greedily, most expensive first, to the shard with
+    the least total cost. The result only depends on the file names and
+    their costs, so every machine computes the same assignment.
+
+    """
+    file_costs = _shard_costs(filenames, costs)
+
+    loads = [(0, index) for index in range(count)]
+    assignment = [[] for _ in range(count)]
+    for name in sorted(file_costs,
+                       key=lambda name: (-file_costs[name], name)):
+        (load, index) = loads[0]
+        assignment[index].append(name)
+        loads[0] = (load + file_costs[name], index)
+        loads.sort()
+
+    return [sorted(names) for names in assignment]
+
+
+def _write_shard_manifest(filename, assignment):
+    """Write which files each shard formats to filename as JSON."""
+    with open(filename, 'w') as manifest_file:
+        json.dump([{'shard': '{0}/{1}'.format(index + 1, len(assignment)),
+                    'size': sum(_file_size(name) for name in names),
+                    'files': names}
+                   for (index, names) in enumerate(assignment)],
+                  manifest_file,
+                  indent=2)
+
+
+def _skipped_files(filenames, args):
+    """Return set of files that _format_file() would skip."""
+    skipped = set()
+    if args.max_file_size or args.skip_generated:
+        for name in filenames:
+            try:
+                if _skip_reason(name, args):
+                    skipped.add(name)
+            except IOError:
+                pass
+    return skipped
+
+
+def _group_duplicates(filenames, args, skipped=()):
+    """Return list of groups of files with identical contents and options.
+
+    Only files that share their size with another file are hashed. Files
+    in skipped are neither hashed nor grouped.
+
+    """
+    sizes = dict((name, _file_size(name)) for name in filenames
+                 if name not in skipped)
+    size_counts = collections.Counter(sizes.values())
+
+    groups = collections.OrderedDict()
+    for name in filenames:
+        key = (name,)
+        if name in sizes and size_counts[sizes[name]] > 1:
+            try:
+                with open(name, 'rb') as input_file:
+                    digest = hashlib.sha1(input_file.read()).digest()
+            except IOError:
+                pass
+            else:
+                key = (sizes[name], digest,
+                       tuple(stage_key
+                             for (stage_key, _) in _cached_stages(args,
+                                                                  name)))
+        groups.setdefault(key, []).append(name)
+
+    return list(groups.values())
+
+
+def _format_group(names, args, standard_out, standard_error, read=None,
+                  cache=None):
+    """Format the first of names and copy the result to the others.
+
+    The files must have identical contents and options. Return list of
+    _Result for names.
+
+    """
+    report = {}
+    first = _format_file((names[0], args, standard_out, standard_error),
+                         read=read, cache=cache, report=report)
+    results = [first]
+
+    standard_error = standard_error or sys.stderr
+    for name in names[1:]:
+        if args.verbose:
+            print('{0}: '.format(name), end='', file=standard_error)
+
+        result = first._replace(memory=None)
+        if first.changed:
+            try:
+                if args.in_place:
+                    with autopep8.open_with_encoding(
+                            name, mode='w',
+                            encoding=report['encoding']) as output_file:
+                        output_file.write(report['formatted_source'])
+                else:
+                    _write_diff(report['source'], report['formatted_source'],
+                                name, standard_out)
+            except IOError as exception:
+                print('{}'.format(exception), file=standard_error)
+                result = result._replace(changed=False, error=True)
+        elif first.error:
+            # The error message of the first file names only that file.
+            if not args.verbose:
+                print('{0}: '.format(name), end='', file=standard_error)
+            print('error (same as {0})'.format(names[0]),
+                  file=standard_error)
+
+        if args.verbose and not result.error:
+            if result.skipped:
+                status = 'skipped ({0})'.format(result.skipped)
+            else:
+                status = 'changed' if result.changed else 'unchanged'
+            print('{0} (same as {1})'.format(status, names[0]),
+                  file=standard_error)
+
+        results.append(result)
+
+    return results
 
 
 def format_multiple_files(filenames, args, standard_out, standard_error):
@@ -144,25 +853,242 @@ def format_multiple_files(filenames, args, standard_out, standard_error):
     Optionally format files recursively.
 
     """
-    filenames = autopep8.find_files(list(filenames),
-                                    args.recursive,
-                                    args.exclude_patterns)
-    if args.jobs > 1:
-        import multiprocessing
-        pool = multiprocessing.Pool(args.jobs)
+    filenames = list(autopep8.find_files(list(filenames),
+                                         args.recursive,
+                                         args.exclude_patterns))
+
+    if args.shard:
+        (index, count) = args.shard
+        assignment = shards(filenames, count, args.shard_costs)
+        if args.shard_manifest:
+            _write_shard_manifest(args.shard_manifest, assignment)
+        filenames = assignment[index - 1]
 
-        # We pass neither standard_out nor standard_error into "_format_file()"
-        # since multiprocessing cannot serialize io.
-        result = pool.map(_format_file,
-                          [(name, args, None, None) for name in filenames])
+    jobs = args.jobs
+    if jobs == AUTO_JOBS:
+        jobs = _auto_jobs(filenames)
+
+    started_tracing = False
+    if args.memory_report:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+
+    skipped = _skipped_files(filenames, args)
+    groups = _group_duplicates(filenames, args, skipped)
+    filenames = [name for names in groups for name in names]
+
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs,
+                                    initializer=_initialize_worker,
+                                    initargs=(args,))
+        try:
+            group_results = []
+            chunk_size = max(1, len(groups) // (jobs * 4))
+            for (results, diff) in pool.imap(_format_group_in_worker,
+                                             groups, chunk_size):
+                standard_out.write(diff)
+                group_results.append(results)
+        finally:
+            pool.close()
+            pool.join()
+    elif (args.max_inflight_mb > 0 and len(groups) > 1 and
+          not args.memory_report):
+        # Reading ahead would attribute allocations to the wrong file.
+        # Skipped files are not read ahead since only their start is read.
+        group_results = []
+        with contextlib.closing(
+                _read_ahead([names[0] for names in groups
+                             if names[0] not in skipped],
+                            args.max_inflight_mb * 1024 * 1024)) as reads:
+            for names in groups:
+                read = None
+                if names[0] not in skipped:
+                    (_, read) = next(reads)
+                group_results.append(
+                    _format_group(names, args, standard_out, standard_error,
+                                  read=read))
     else:
-        result = [_format_file((name, args, standard_out, standard_error))
-                  for name in filenames]
+        group_results = [
+            _format_group(names, args, standard_out, standard_error)
+            for names in groups]
+
+    result = [file_result
+              for results in group_results
+              for file_result in results]
+
+    if args.verbose:
+        skipped = sum(1 for changed_and_error in result
+                      if changed_and_error.skipped)
+        if skipped:
+            print('skipped {0} of {1} files'.format(skipped, len(result)),
+                  file=standard_error or sys.stderr)
+
+    if args.memory_report:
+        if started_tracing:
+            tracemalloc.stop()
+        _print_memory_report(filenames, result,
+                             standard_error or sys.stderr)
 
     return (any(changed_and_error[0] for changed_and_error in result),
             any(changed_and_error[1] for changed_and_error in result))
 
 
+def _stat_signature(filename):
+    """Return signature of file status or None if it cannot be read."""
+    try:
+        status = os.stat(filename)
+    except OSError:
+        return None
+
+    return (status.st_mtime, status.st_size, status.st_ino)
+
+
+def _snapshot(paths, args):
+    """Return dictionary mapping files under paths to their signatures."""
+    return dict((name, _stat_signature(name))
+                for name in autopep8.find_files(list(paths),
+                                                True,
+                                                args.exclude_patterns)
+                if os.path.isfile(name))
+
+
+def _configuration_snapshot(filenames):
+    """Return signatures of the configuration files that apply to filenames.
+
+    These are the files autopep8 looks for in the directory of each file
+    and its parents, as well as the user's global configuration file.
+
+    """
+    directories = set()
+    for name in filenames:
+        directory = os.path.dirname(os.path.abspath(name))
+        while directory not in directories:
+            directories.add(directory)
+            directory = os.path.dirname(directory)
+
+    candidates = [autopep8.DEFAULT_CONFIG]
+    for directory in directories:
+        candidates += [os.path.join(directory, name)
+                       for name in autopep8.PROJECT_CONFIG +
+                       ('pyproject.toml',)]
+
+    return dict((name, _stat_signature(name)) for name in candidates)
+
+
+def watch(paths, args, standard_out, standard_error,
+          sleep=time.sleep, polls=None):
+    """Format files under paths whenever they change.
+
+    Files are polled every "args.watch_interval" seconds. A batch of
+    changed files is formatted once a poll finds no further changes.
+    Editing a configuration file causes the options to be resolved again
+    for the next batch. Return after the given number of polls, which is
+    unlimited by default.
+
+    Return 1 if any file could not be formatted and 0 otherwise.
+
+    """
+    cache = StageCache()
+    signatures = _snapshot(paths, args)
+    configuration = _configuration_snapshot(signatures)
+    pending = set()
+    any_errors = False
+
+    try:
+        while polls is None or polls > 0:
+            if polls is not None:
+                polls -= 1
+
+            sleep(args.watch_interval)
+
+            current = _snapshot(paths, args)
+            changed = set(name for (name, signature) in current.items()
+                          if signatures.get(name) != signature)
+            signatures = current
+
+            if changed:
+                pending |= changed
+                continue
+
+            if not pending:
+                continue
+
+            current = _configuration_snapshot(signatures)
+            if current != configuration:
+                _stages_by_configuration.clear()
+                cache.clear()
+            configuration = current
+
+            for name in sorted(pending & set(signatures)):
+                result = _format_file(
+                    (name, args, standard_out, standard_error),
+                    cache=cache)
+                any_errors |= result.error
+
+                if result.skipped:
+                    print('{0}: skipped ({1})'.format(name, result.skipped),
+                          file=standard_out)
+                elif args.in_place and not result.error:
+                    print('{0}: {1}'.format(
+                        name, 'changed' if result.changed else 'unchanged'),
+                        file=standard_out)
+                standard_out.flush()
+
+                # Do not treat our own changes as new edits.
+                signatures[name] = _stat_signature(name)
+
+            pending.clear()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+
+    return 1 if any_errors else 0
+
+
+def _jobs(value):
+    """Return number of jobs parsed from value."""
+    if value == AUTO_JOBS:
+        return value
+
+    try:
+        return int(value)
+    except ValueError:
+        import argparse
+        raise argparse.ArgumentTypeError(
+            'expected an integer or "{0}"'.format(AUTO_JOBS))
+
+
+def _shard(value):
+    """Return (index, count) parsed from "INDEX/COUNT"."""
+    try:
+        (index, count) = [int(number) for number in value.split('/')]
+    except ValueError:
+        index = count = 0
+
+    if not 1 <= index <= count:
+        import argparse
+        raise argparse.ArgumentTypeError(
+            'expected INDEX/COUNT with 1 <= INDEX <= COUNT')
+
+    return (index, count)
+
+
+def _positive(value):
+    """Return positive integer parsed from value."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number < 1:
+        import argparse
+        raise argparse.ArgumentTypeError('expected a positive integer')
+
+    return number
+
+
 def parse_args(argv):
     """Return parsed arguments."""
     import argparse
@@ -179,11 +1105,38 @@ def parse_args(argv):
                              '(requires "aggressive")')
     parser.add_argument('--remove-unused-variables', action='store_true',
                         help='remove unused variables (requires "aggressive")')
-    parser.add_argument('-j', '--jobs', type=int, metavar='n', default=1,
+    parser.add_argument('-j', '--jobs', type=_jobs, metavar='n', default=1,
                         help='number of parallel jobs; '
-                             'match CPU count if value is less than 1')
+                             'match CPU count if value is less than 1; '
+                             '"auto" picks a count based on the amount of '
+                             'source to format')
+    parser.add_argument('--max-inflight-mb', type=int, default=64,
+                        metavar='n',
+                        help='maximum megabytes of files to read ahead of '
+                             'formatting them when running serially; '
+                             '0 disables reading ahead (default: '
+                             '%(default)s)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='print verbose messages')
+    parser.add_argument('--until-stable', action='store_true',
+                        help='keep formatting until the output stops '
+                             'changing, rerunning only the formatters whose '
+                             'input changed')
+    parser.add_argument('--max-passes', type=_positive, default=10,
+                        metavar='n',
+                        help='maximum passes over the formatters with '
+                             '--until-stable (default: %(default)s)')
+    parser.add_argument('--max-file-size', type=int, default=0,
+                        metavar='bytes',
+                        help='skip files larger than this; '
+                             '0 means no limit (default: %(default)s)')
+    parser.add_argument('--skip-generated', action='store_true',
+                        help='skip files that look generated, such as files '
+                             'with "@generated" or "DO NOT EDIT" near the '
+                             'top or with very long lines')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='trace memory allocated by each stage and file '
+                             'and print the largest consumers')
     parser.add_argument('--exclude', action='append',
                         dest='exclude_patterns', default=[], metavar='pattern',
                         help='exclude files this pattern; '
@@ -194,15 +1147,42 @@ def parse_args(argv):
                              'files; if not passed, defaults are updated with '
                              "any config files in the project's root "
                              'directory')
+    parser.add_argument('--shard', type=_shard, metavar='INDEX/COUNT',
+                        help='only format the INDEX-th of COUNT parts of '
+                             'the files, balanced by file size or by '
+                             '--shard-costs; INDEX starts at 1')
+    parser.add_argument('--shard-costs', metavar='filename',
+                        help='JSON file mapping file names to their cost '
+                             'for balancing --shard, such as a baseline '
+                             'written by "test_acid.py --write-baseline"')
+    parser.add_argument('--shard-manifest', metavar='filename',
+                        help='write which files each --shard formats to a '
+                             'JSON file')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and format files under the given '
+                             'paths whenever they change')
+    parser.add_argument('--watch-interval', type=float, default=1.0,
+                        metavar='seconds',
+                        help='seconds between polls for changes in watch '
+                             'mode (default: %(default)s)')
     parser.add_argument('--version', action='version',
                         version='%(prog)s ' + __version__)
     parser.add_argument('files', nargs='+', help='files to format')
 
     args = parser.parse_args(argv[1:])
 
-    if args.jobs < 1:
-        import multiprocessing
-        args.jobs = multiprocessing.cpu_count()
+    if args.shard_costs:
+        try:
+            with open(args.shard_costs) as costs_file:
+                costs = json.load(costs_file)
+        except (IOError, ValueError) as exception:
+            parser.error('cannot read --shard-costs: {0}'.format(exception))
+        if not isinstance(costs, dict):
+            parser.error('--shard-costs must contain a JSON object')
+        args.shard_costs = costs.get('seconds', costs)
+
+    if args.jobs != AUTO_JOBS and args.jobs < 1:
+        args.jobs = cpu_count()
 
     return args
 
@@ -215,8 +1195,13 @@ def _main(argv, standard_out, standard_error):
     """
     args = parse_args(argv)
 
-    if args.jobs > 1 and not args.in_place:
-        print('parallel jobs requires --in-place',
+    if args.memory_report and sys.version_info < (3, 4):
+        print('--memory-report requires Python 3.4 or newer',
+              file=standard_error)
+        return 2
+
+    if args.watch and args.jobs != 1:
+        print('--watch does not support parallel jobs',
               file=standard_error)
         return 2
 
@@ -231,6 +1216,9 @@ def _main(argv, standard_out, standard_error):
                   file=standard_error)
             return 2
 
+    if args.watch:
+        return watch(set(args.files), args, standard_out, standard_error)
+
     changed_and_error = format_multiple_files(set(args.files),
                                               args,
                                               standard_out,
@@ -4,9 +4,12 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import hashlib
+import json
 import os
 import sys
 import subprocess
+import time
 
 
 ROOT_PATH = os.path.abspath(os.path.dirname(__file__))
@@ -54,6 +57,10 @@ def run(filename, verbose=False, options=None):
     if not options:
         options = []
 
+    if not check_syntax(filename):
+        # pyformat refuses to format files that are invalid to begin with.
+        return True
+
     import test_pyformat
     with test_pyformat.temporary_directory() as temp_directory:
         temp_filename = os.path.join(temp_directory,
@@ -71,14 +78,13 @@ def run(filename, verbose=False, options=None):
             if verbose:
                 sys.stderr.write(file_diff)
 
-            if check_syntax(filename):
-                try:
-                    check_syntax(temp_filename, raise_error=True)
-                except (SyntaxError, TypeError,
-                        UnicodeDecodeError) as exception:
-                    sys.stderr.write('pyformat broke ' + filename + '\n' +
-                                     str(exception) + '\n')
-                    return False
+            try:
+                check_syntax(temp_filename, raise_error=True)
+            except (SyntaxError, TypeError,
+                    UnicodeDecodeError) as exception:
+                sys.stderr.write('pyformat broke ' + filename + '\n' +
+                                 str(exception) + '\n')
+                return False
         except IOError as exception:
             sys.stderr.write(str(exception) + '\n')
 
@@ -111,6 +117,30 @@ def process_args():
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='print verbose messages')
 
+    parser.add_argument('--in-process', action='store_true',
+                        help='call format_code() in a pool of processes '
+                             'instead of running pyformat on each file; '
+                             'this also checks that formatting is '
+                             'idempotent')
+
+    parser.add_argument('-j', '--jobs', type=int, default=0, metavar='n',
+                        help='number of processes for --in-process; '
+                             'match CPU count if value is less than 1')
+
+    parser.add_argument('--baseline', metavar='filename',
+                        help='compare outputs and throughput of '
+                             '--in-process against a baseline')
+
+    parser.add_argument('--write-baseline', metavar='filename',
+                        help='save outputs and throughput of --in-process '
+                             'as a baseline')
+
+    parser.add_argument('--slowdown-tolerance', type=float, default=0.25,
+                        metavar='fraction',
+                        help='fail if throughput drops by more than this '
+                             'fraction compared to the baseline '
+                             '(default: %(default)s)')
+
     parser.add_argument('files', nargs='*', help='files to format')
 
     return parser.parse_args()
@@ -174,9 +204,163 @@ def check(args):
     return True
 
 
+def find_python_files(paths):
+    """Yield real paths of Python files under paths, without duplicates."""
+    completed_filenames = set()
+    for path in paths:
+        for root, directories, children in os.walk(path):
+            directories[:] = sorted(d for d in directories
+                                    if not d.startswith('.'))
+            for name in sorted(children):
+                name = os.path.realpath(os.path.join(root, name))
+                if (
+                    name.endswith('.py') and
+                    not os.path.basename(name).startswith('.') and
+                    os.path.exists(name) and
+                    name not in completed_filenames
+                ):
+                    completed_filenames.add(name)
+                    yield name
+
+        if os.path.isfile(path):
+            name = os.path.realpath(path)
+            if name not in completed_filenames:
+                completed_filenames.add(name)
+                yield name
+
+
+_aggressive = False
+
+
+def _initialize_worker(aggressive):
+    """Store the pyformat options that every file is checked with."""
+    global _aggressive
+    _aggressive = aggressive
+
+
+def check_in_process(filename):
+    """Format file in memory and check the result.
+
+    Return (filename, error, digest, seconds). error is None if the
+    formatted code compiles and formatting it again changes nothing.
+
+    """
+    import pyformat
+
+    try:
+        with autopep8.open_with_encoding(
+                filename,
+                encoding=autopep8.detect_encoding(filename)) as input_file:
+            source = input_file.read()
+        compile(source, '<string>', 'exec', dont_inherit=True)
+    except (IOError, SyntaxError, TypeError, UnicodeDecodeError, ValueError):
+        # Only check files that are valid to begin with.
+        return (filename, None, None, 0.)
+
+    start = time.time()
+    try:
+        formatted_source = pyformat.format_code(source,
+                                                aggressive=_aggressive)
+    except Exception as exception:
+        return (filename, 'pyformat crashed: {0!r}'.format(exception),
+                None, 0.)
+    seconds = time.time() - start
+
+    try:
+        compile(formatted_source, '<string>', 'exec', dont_inherit=True)
+    except (SyntaxError, TypeError, ValueError) as exception:
+        error = 'pyformat broke syntax: {0}'.format(exception)
+    else:
+        if pyformat.format_code(formatted_source,
+                                aggressive=_aggressive) != formatted_source:
+            error = 'pyformat is not idempotent'
+        else:
+            error = None
+
+    digest = hashlib.sha1(
+        formatted_source.encode('utf-8', 'surrogatepass')).hexdigest()
+    return (filename, error, digest, seconds)
+
+
+def check_corpus(args):
+    """Format corpus in a pool of processes and report throughput.
+
+    Return False if any file fails its checks or if outputs or throughput
+    regressed compared to the baseline.
+
+    """
+    import multiprocessing
+
+    paths = args.files or [path for path in sys.path if os.path.isdir(path)]
+    filenames = list(find_python_files(paths))
+
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs,
+                                initializer=_initialize_worker,
+                                initargs=(args.aggressive,))
+
+    success = True
+    digests = {}
+    seconds = {}
+    start = time.time()
+    try:
+        for (name, error, digest, elapsed) in pool.imap_unordered(
+                check_in_process, filenames, chunksize=8):
+            if error:
+                sys.stderr.write(error + ': ' + name + '\n')
+                success = False
+            elif args.verbose:
+                sys.stderr.write(colored('--->  Tested ' + name + '\n',
+                                         YELLOW))
+
+            if digest:
+                digests[name] = digest
+                seconds[name] = elapsed
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    files_per_second = len(filenames) / elapsed if elapsed else 0.
+    print('{0} files in {1:.1f} s ({2:.1f} files/s)'.format(
+        len(filenames), elapsed, files_per_second), file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        for name in sorted(set(digests) & set(baseline['digests'])):
+            if digests[name] != baseline['digests'][name]:
+                sys.stderr.write('output differs from baseline: ' +
+                                 name + '\n')
+                success = False
+
+        minimum = ((1 - args.slowdown_tolerance) *
+                   baseline['files_per_second'])
+        if files_per_second < minimum:
+            sys.stderr.write(
+                'throughput dropped from {0:.1f} to {1:.1f} files/s\n'.format(
+                    baseline['files_per_second'], files_per_second))
+            success = False
+
+    if args.write_baseline:
+        with open(args.write_baseline, 'w') as baseline_file:
+            json.dump({'files_per_second': files_per_second,
+                       'digests': digests,
+                       'seconds': seconds},
+                      baseline_file,
+                      indent=2,
+                      sort_keys=True)
+
+    return success
+
+
 def main():
     """Run main."""
-    return 0 if check(process_args()) else 1
+    args = process_args()
+    if args.in_process:
+        return 0 if check_corpus(args) else 1
+    return 0 if check(args) else 1
 
 
 if __name__ == '__main__':
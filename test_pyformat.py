@@ -7,6 +7,7 @@ from __future__ import unicode_literals
 
 import contextlib
 import io
+import json
 import os
 import shutil
 import subprocess
@@ -80,6 +81,97 @@ class TestUnits(unittest.TestCase):
                 aggressive=True,
                 remove_unused_variables=True))
 
+    def test_format_code_with_syntax_error(self):
+        self.assertRaises(SyntaxError, pyformat.format_code, 'def f(:\n')
+
+    def test_format_code_shares_tree_with_autoflake(self):
+        checked = []
+        check = pyformat.autoflake.check
+
+        def check_and_record(code):
+            checked.append(code)
+            return check(code)
+
+        pyformat.autoflake.check = check_and_record
+        try:
+            self.assertEqual(
+                'x = 1\n',
+                pyformat.format_code('import os\nx = 1\n', aggressive=True))
+        finally:
+            pyformat.autoflake.check = check
+
+        # Only autoflake's own reformatted source gets parsed again.
+        self.assertNotIn('import os\nx = 1\n', checked)
+
+    def test_format_code_with_cache(self):
+        cache = pyformat.StageCache()
+        self.assertEqual(
+            "x = 'abc'\n",
+            pyformat.format_code('x = "abc"\n', cache=cache))
+        self.assertEqual(3, len(cache))
+
+        self.assertEqual(
+            "x = 'abc'\n",
+            pyformat.format_code('x = "abc"\n', cache=cache))
+        self.assertEqual(3, len(cache))
+
+        # The docformatter and unify stages see the same input as before.
+        self.assertEqual(
+            "x = 'abc'\n",
+            pyformat.format_code('x = "abc"\n', aggressive=True, cache=cache))
+        self.assertEqual(5, len(cache))
+
+    def test_format_code_without_cache(self):
+        self.assertEqual(
+            "x = 'abc'\n",
+            pyformat.format_code('x = "abc"\n', cache=None))
+
+    def test_stage_cache_evicts_least_recently_used(self):
+        cache = pyformat.StageCache(max_size=2 * sys.getsizeof('abc'))
+        cache.put('a', 'abc')
+        cache.put('b', 'def')
+        self.assertEqual('abc', cache.get('a'))
+
+        cache.put('c', 'ghi')
+        self.assertEqual('abc', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('ghi', cache.get('c'))
+
+        cache.put('d', 'too long' * 10)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(2, len(cache))
+
+    def test_run_stages_until_stable(self):
+        calls = []
+
+        def stage(name, old, new):
+            def fix(code):
+                calls.append(name)
+                return code.replace(old, new)
+            return ((name,), fix)
+
+        stages = [stage('first', 'b', 'c'),
+                  stage('second', 'x', 'y'),
+                  stage('third', 'a', 'z')]
+
+        self.assertEqual(
+            ('z', 2),
+            pyformat._run_stages_until_stable('a', stages, cache=None))
+        # "third" is not rerun on its own output.
+        self.assertEqual(['first', 'second', 'third', 'first', 'second'],
+                         calls)
+
+    def test_run_stages_until_stable_with_max_passes(self):
+        def fix(code):
+            return code + 'x'
+
+        self.assertEqual(
+            ('xxxxxx', 3),
+            pyformat._run_stages_until_stable('', [(('grow',), fix),
+                                                   (('more',), fix)],
+                                              cache=None,
+                                              max_passes=3))
+
     def test_format_multiple_files(self):
         with temporary_file('''\
 if True:
@@ -141,6 +233,164 @@ if True:
         self.assertFalse(result[0])
         self.assertTrue(result[1])
 
+    def test_format_group_in_worker(self):
+        with temporary_file('''\
+if True:
+    x = "abc"
+''') as filename:
+            pyformat._initialize_worker(
+                pyformat.parse_args(['my_fake_program', '--in-place', '']))
+            try:
+                ([result], diff) = pyformat._format_group_in_worker(
+                    [filename])
+                self.assertTrue(result.changed)
+                self.assertEqual('', diff)
+                self.assertFalse(result.error)
+            finally:
+                pyformat._initialize_worker(None)
+
+            with open(filename) as f:
+                self.assertEqual('''\
+if True:
+    x = 'abc'
+''', f.read())
+
+    def test_read_ahead(self):
+        with temporary_file('x = 1\n') as first:
+            with temporary_file('y = 2\n') as second:
+                reads = list(pyformat._read_ahead(
+                    [first, 'nonexistent_file', second], max_bytes=1))
+
+                self.assertEqual([first, 'nonexistent_file', second],
+                                 [name for (name, _) in reads])
+                self.assertEqual('x = 1\n', reads[0][1]()[1])
+                self.assertRaises(IOError, reads[1][1])
+                self.assertEqual('y = 2\n', reads[2][1]()[1])
+
+    def test_shards(self):
+        with temporary_directory() as directory:
+            filenames = []
+            for (name, size) in [('a', 50), ('b', 40), ('c', 30), ('d', 20)]:
+                filenames.append(os.path.join(directory, name + '.py'))
+                with open(filenames[-1], 'w') as f:
+                    f.write(size * '#')
+
+            self.assertEqual(
+                [[filenames[0], filenames[3]], [filenames[1], filenames[2]]],
+                pyformat.shards(filenames, 2))
+
+            self.assertEqual(
+                [[filenames[0], filenames[2]], [filenames[1], filenames[3]]],
+                pyformat.shards(filenames, 2,
+                                costs={filenames[3]: 10.,
+                                       filenames[2]: 1.}))
+
+    def test_parse_args_with_shard(self):
+        self.assertEqual(
+            (2, 3),
+            pyformat.parse_args(['my_fake_program', '--shard=2/3', '']).shard)
+
+    def test_parse_args_with_invalid_max_passes(self):
+        for value in ['0', '-1', 'x']:
+            with contextlib.closing(io.StringIO()) as error_file:
+                standard_error = sys.stderr
+                sys.stderr = error_file
+                try:
+                    self.assertRaises(
+                        SystemExit, pyformat.parse_args,
+                        ['my_fake_program', '--max-passes=' + value, ''])
+                finally:
+                    sys.stderr = standard_error
+
+                self.assertIn('expected a positive integer',
+                              error_file.getvalue())
+
+    def test_skip_reason(self):
+        args = pyformat.parse_args(['my_fake_program', '--skip-generated',
+                                    '--max-file-size=100', ''])
+
+        with temporary_file('x = 1\n') as filename:
+            self.assertIsNone(pyformat._skip_reason(filename, args))
+
+        with temporary_file('# @generated\nx = 1\n') as filename:
+            self.assertEqual('generated',
+                             pyformat._skip_reason(filename, args))
+
+        with temporary_file('x = 1\n' * 20) as filename:
+            self.assertEqual('larger than 100 bytes',
+                             pyformat._skip_reason(filename, args))
+
+        args.max_file_size = 0
+        with temporary_file('x = [{0}]\n'.format('1, ' * 500)) as filename:
+            self.assertEqual('generated',
+                             pyformat._skip_reason(filename, args))
+
+    def test_group_duplicates(self):
+        with temporary_directory() as directory:
+            filenames = []
+            for (name, contents) in [('a', 'x = 1\n'), ('b', 'y = 2\n'),
+                                     ('c', 'x = 1\n'), ('d', 'z = 33\n')]:
+                filenames.append(os.path.join(directory, name + '.py'))
+                with open(filenames[-1], 'w') as f:
+                    f.write(contents)
+
+            self.assertEqual(
+                [[filenames[0], filenames[2]], [filenames[1]],
+                 [filenames[3]]],
+                pyformat._group_duplicates(
+                    filenames,
+                    pyformat.parse_args(['my_fake_program', ''])))
+
+    def test_group_duplicates_with_skipped_files(self):
+        with temporary_directory() as directory:
+            filenames = []
+            for name in ['a', 'b']:
+                filenames.append(os.path.join(directory, name + '.py'))
+                with open(filenames[-1], 'w') as f:
+                    f.write('x = 1\n')
+
+            self.assertEqual(
+                [[filenames[0]], [filenames[1]]],
+                pyformat._group_duplicates(
+                    filenames,
+                    pyformat.parse_args(['my_fake_program', '']),
+                    skipped=set(filenames)))
+
+    def test_cpu_count(self):
+        self.assertGreaterEqual(pyformat.cpu_count(), 1)
+
+    def test_cgroup_cpu_quota(self):
+        with temporary_directory() as directory:
+            self.assertIsNone(pyformat._cgroup_cpu_quota(directory))
+
+            with open(os.path.join(directory, 'cpu.max'), 'w') as f:
+                f.write('max 100000\n')
+            self.assertIsNone(pyformat._cgroup_cpu_quota(directory))
+
+            with open(os.path.join(directory, 'cpu.max'), 'w') as f:
+                f.write('250000 100000\n')
+            self.assertEqual(2.5, pyformat._cgroup_cpu_quota(directory))
+
+    def test_cgroup_cpu_quota_with_version_1(self):
+        with temporary_directory() as directory:
+            os.mkdir(os.path.join(directory, 'cpu'))
+            with open(os.path.join(directory, 'cpu',
+                                   'cpu.cfs_quota_us'), 'w') as f:
+                f.write('400000\n')
+            with open(os.path.join(directory, 'cpu',
+                                   'cpu.cfs_period_us'), 'w') as f:
+                f.write('100000\n')
+            self.assertEqual(4, pyformat._cgroup_cpu_quota(directory))
+
+    def test_auto_jobs_with_small_batch(self):
+        self.assertEqual(1, pyformat._auto_jobs([__file__,
+                                                 'nonexistent_file']))
+
+    def test_parse_args_with_auto_jobs(self):
+        self.assertEqual(
+            pyformat.AUTO_JOBS,
+            pyformat.parse_args(['my_fake_program', '--jobs=auto', '']).jobs)
+
 
 class TestSystem(unittest.TestCase):
 
@@ -249,16 +499,340 @@ if True:
     x = 'abc'
 ''', f.read())
 
-    def test_multiple_jobs_should_require_in_place(self):
+    def test_auto_jobs(self):
+        with temporary_file('''\
+if True:
+    x = "abc"
+''') as filename:
+            output_file = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--in-place',
+                                 '--jobs=auto', filename],
+                           standard_out=output_file,
+                           standard_error=None)
+            with open(filename) as f:
+                self.assertEqual('''\
+if True:
+    x = 'abc'
+''', f.read())
+
+    def test_auto_jobs_without_in_place(self):
+        with temporary_file('''\
+import os
+x = "abc"
+''') as filename:
+            output_file = io.StringIO()
+            self.assertEqual(
+                0,
+                pyformat._main(argv=['my_fake_program', '--jobs=auto',
+                                     filename],
+                               standard_out=output_file,
+                               standard_error=None))
+            self.assertIn("+x = 'abc'", output_file.getvalue())
+
+    def test_watch(self):
+        with temporary_directory() as directory:
+            with temporary_file("""\
+if True:
+    x = 'abc'
+""", directory=directory) as filename:
+                def edit(_):
+                    with open(filename, 'a') as f:
+                        f.write('y = "def"\n')
+                edits = [edit]
+
+                def sleep(seconds):
+                    if edits:
+                        edits.pop()(seconds)
+
+                output_file = io.StringIO()
+                self.assertEqual(
+                    0,
+                    pyformat.watch(
+                        [directory],
+                        pyformat.parse_args(['my_fake_program', '--in-place',
+                                             '--watch', directory]),
+                        standard_out=output_file,
+                        standard_error=output_file,
+                        sleep=sleep,
+                        polls=3))
+
+                self.assertEqual(
+                    os.path.basename(filename) + ': changed\n',
+                    os.path.basename(output_file.getvalue()))
+                with open(filename) as f:
+                    self.assertEqual("""\
+if True:
+    x = 'abc'
+y = 'def'
+""", f.read())
+
+    def test_read_ahead_with_multiple_files(self):
+        with temporary_file('''\
+x = "abc"
+''') as first:
+            with temporary_file('''\
+y = "def"
+''') as second:
+                output_file = io.StringIO()
+                pyformat._main(argv=['my_fake_program', '--in-place',
+                                     '--max-inflight-mb=1', first, second],
+                               standard_out=output_file,
+                               standard_error=None)
+                with open(first) as f:
+                    self.assertEqual("x = 'abc'\n", f.read())
+                with open(second) as f:
+                    self.assertEqual("y = 'def'\n", f.read())
+
+    def test_watch_with_configuration_change(self):
+        with temporary_directory() as directory:
+            setup_cfg = os.path.join(directory, 'setup.cfg')
+            with open(setup_cfg, 'w') as f:
+                f.write('[pep8]\nignore=E\n')
+
+            with temporary_file('', directory=directory) as filename:
+                def append(text):
+                    with open(filename, 'a') as f:
+                        f.write(text)
+
+                def configure():
+                    with open(setup_cfg, 'w') as f:
+                        f.write('[pep8]\n')
+                    append('y =2\n')
+
+                edits = [None, configure, None, lambda: append('x =1\n')]
+
+                def sleep(_):
+                    edit = edits.pop()
+                    if edit:
+                        edit()
+
+                output_file = io.StringIO()
+                self.assertEqual(
+                    0,
+                    pyformat.watch(
+                        [directory],
+                        pyformat.parse_args(['my_fake_program', '--in-place',
+                                             '--watch', directory]),
+                        standard_out=output_file,
+                        standard_error=output_file,
+                        sleep=sleep,
+                        polls=4))
+
+                with open(filename) as f:
+                    self.assertEqual('x = 1\ny = 2\n', f.read())
+
+    def test_watch_should_not_allow_multiple_jobs(self):
         output_file = io.StringIO()
         self.assertEqual(
             2,
-            pyformat._main(argv=['my_fake_program',
-                                 '--jobs=2', __file__],
+            pyformat._main(argv=['my_fake_program', '--in-place', '--watch',
+                                 '--jobs=2', ROOT_DIRECTORY],
                            standard_out=output_file,
                            standard_error=output_file))
 
-        self.assertIn('requires --in-place', output_file.getvalue())
+    def test_shard(self):
+        with temporary_directory() as directory:
+            with temporary_file('''\
+x = "abc"
+''', directory=directory) as first:
+                with temporary_file('''\
+y = "def"
+''', directory=directory) as second:
+                    manifest = os.path.join(directory, 'manifest.json')
+                    output_file = io.StringIO()
+                    pyformat._main(argv=['my_fake_program', '--in-place',
+                                         '--shard=1/2',
+                                         '--shard-manifest', manifest,
+                                         first, second],
+                                   standard_out=output_file,
+                                   standard_error=None)
+
+                    changed = []
+                    for filename in [first, second]:
+                        with open(filename) as f:
+                            if '"' not in f.read():
+                                changed.append(filename)
+                    self.assertEqual(1, len(changed))
+
+                    with open(manifest) as f:
+                        self.assertEqual(
+                            [['1/2', changed], ['2/2', list(
+                                set([first, second]) - set(changed))]],
+                            [[shard['shard'], shard['files']]
+                             for shard in json.load(f)])
+
+    def test_memory_report(self):
+        with temporary_file('''\
+import os
+x = "abc"
+''') as filename:
+            output_file = io.StringIO()
+            error_file = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--memory-report',
+                                 filename],
+                           standard_out=output_file,
+                           standard_error=error_file)
+            self.assertIn("+x = 'abc'", output_file.getvalue())
+
+            report = error_file.getvalue()
+            self.assertIn('memory report', report)
+            for phase in ['read', 'autopep8', 'docformatter', 'unify', 'diff']:
+                self.assertIn(phase, report)
+            self.assertIn(filename, report)
+
+    def test_memory_report_with_multiple_jobs(self):
+        with temporary_file('''\
+x = "abc"
+''') as filename:
+            error_file = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--memory-report',
+                                 '--in-place', '--jobs=2', filename],
+                           standard_out=io.StringIO(),
+                           standard_error=error_file)
+            self.assertIn('write', error_file.getvalue())
+            self.assertIn(filename, error_file.getvalue())
+
+    def test_skip_generated(self):
+        with temporary_file('''\
+# Code generated by a tool. DO NOT EDIT.
+x = "abc"
+''') as filename:
+            output_file = io.StringIO()
+            error_file = io.StringIO()
+            self.assertEqual(
+                0,
+                pyformat._main(argv=['my_fake_program', '--verbose',
+                                     '--skip-generated', filename],
+                               standard_out=output_file,
+                               standard_error=error_file))
+            self.assertEqual('', output_file.getvalue())
+            self.assertIn('skipped (generated)', error_file.getvalue())
+            self.assertIn('skipped 1 of 1 files', error_file.getvalue())
+
+    def test_skipped_files_are_not_read_ahead(self):
+        with temporary_file('x = "abc"\n' * 20) as large:
+            with temporary_file('x = "abc"\n') as small:
+                read = []
+                read_file = pyformat._read_file
+
+                def read_and_record(filename):
+                    read.append(filename)
+                    return read_file(filename)
+
+                pyformat._read_file = read_and_record
+                try:
+                    pyformat._main(argv=['my_fake_program',
+                                         '--max-file-size=100',
+                                         large, small],
+                                   standard_out=io.StringIO(),
+                                   standard_error=io.StringIO())
+                finally:
+                    pyformat._read_file = read_file
+
+                self.assertEqual([small], read)
+
+    def test_until_stable(self):
+        with temporary_file('''\
+x = "abc"
+''') as filename:
+            error_file = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--in-place', '--verbose',
+                                 '--until-stable', filename],
+                           standard_out=io.StringIO(),
+                           standard_error=error_file)
+            self.assertIn('changed (2 passes)', error_file.getvalue())
+            with open(filename) as f:
+                self.assertEqual("x = 'abc'\n", f.read())
+
+    def test_syntax_error(self):
+        with temporary_file('''\
+def f(:
+    x = "abc"
+''') as filename:
+            output_file = io.StringIO()
+            error_file = io.StringIO()
+            self.assertEqual(
+                1,
+                pyformat._main(argv=['my_fake_program', filename],
+                               standard_out=output_file,
+                               standard_error=error_file))
+            self.assertEqual('', output_file.getvalue())
+            self.assertIn('invalid syntax', error_file.getvalue())
+
+    def test_duplicates(self):
+        with temporary_directory() as directory:
+            first = os.path.join(directory, 'first.py')
+            second = os.path.join(directory, 'second.py')
+            for filename in [first, second]:
+                with open(filename, 'w') as f:
+                    f.write('x = "abc"\n')
+
+            output_file = io.StringIO()
+            error_file = io.StringIO()
+            pyformat._main(argv=['my_fake_program', '--verbose',
+                                 first, second],
+                           standard_out=output_file,
+                           standard_error=error_file)
+            self.assertEqual(2, output_file.getvalue().count("+x = 'abc'"))
+            self.assertIn('fixed/' + first, output_file.getvalue())
+            self.assertIn('fixed/' + second, output_file.getvalue())
+            self.assertIn('(same as ', error_file.getvalue())
+
+            pyformat._main(argv=['my_fake_program', '--in-place',
+                                 first, second],
+                           standard_out=output_file,
+                           standard_error=error_file)
+            for filename in [first, second]:
+                with open(filename) as f:
+                    self.assertEqual("x = 'abc'\n", f.read())
+
+    def test_duplicates_with_syntax_error(self):
+        with temporary_directory() as directory:
+            first = os.path.join(directory, 'first.py')
+            second = os.path.join(directory, 'second.py')
+            for filename in [first, second]:
+                with open(filename, 'w') as f:
+                    f.write('def f(:\n')
+
+            for verbose in [[], ['--verbose']]:
+                error_file = io.StringIO()
+                self.assertEqual(
+                    1,
+                    pyformat._main(argv=['my_fake_program'] + verbose +
+                                   [first, second],
+                                   standard_out=io.StringIO(),
+                                   standard_error=error_file))
+                self.assertTrue(
+                    '{0}: error (same as {1})\n'.format(second, first) in
+                    error_file.getvalue() or
+                    '{0}: error (same as {1})\n'.format(first, second) in
+                    error_file.getvalue())
+
+    def test_diff_with_multiple_jobs(self):
+        with temporary_file('x = "abc"\n') as first:
+            with temporary_file('y = "abc"\n') as second:
+                output_file = io.StringIO()
+                self.assertEqual(
+                    0,
+                    pyformat._main(argv=['my_fake_program', '--jobs=2',
+                                         first, second],
+                                   standard_out=output_file,
+                                   standard_error=output_file))
+
+                # Each file's diff is written in one piece.
+                diffs = output_file.getvalue().split('--- original/')[1:]
+                self.assertEqual(
+                    sorted([first + '\n'
+                            '+++ fixed/' + first + '\n'
+                            '@@ -1 +1 @@\n'
+                            '-x = "abc"\n'
+                            "+x = 'abc'\n",
+                            second + '\n'
+                            '+++ fixed/' + second + '\n'
+                            '@@ -1 +1 @@\n'
+                            '-y = "abc"\n'
+                            "+y = 'abc'\n"]),
+                    sorted(diffs))
 
     def test_jobs_less_than_one_should_default_to_cpu_count(self):
         args = pyformat.parse_args(['my_fake_program',